@@ -8,45 +8,218 @@ Optionally, invoke AWS Lambda API to update a specified function.
 '''
 import argparse
 import base64
-import boto3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import getpass
-import git
 import hashlib
 import json
 import logging
+import mmap
 import os
 import packaging.version
 from pathlib import Path
 import pdb
 import re
+import shlex
+import shutil
 import socket
+import stat
 import subprocess
-from tempfile import TemporaryDirectory
+import sys
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+import threading
 import time
-import toml
-import urllib
-import yaml
-from zipfile import ZipFile
+import urllib.parse
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 
-import botocore.errorfactory
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
+
+# zlib-ng's SIMD-accelerated deflate and crc32 are a drop-in for zlib's; install lambda_zip[zlib-ng] to use them
+try:
+    from zlib_ng import zlib_ng as deflate_zlib
+except ImportError:
+    deflate_zlib = zlib
 
 from lambda_zip.aws_lambda_layer import AwsLambdaLayer
+from lambda_zip.boto3_clients import get_boto3_client
+from lambda_zip.s3_multipart_upload import S3MultipartUpload
 
-local_deps_already_installed = set()
 logger = logging.getLogger(__name__)
-# Exclude these directories by default, because AWS Lambda environment provides them
-zip_omit = set([
-    '^boto3',
-    '^botocore',
-    '^dateutil',
-    '^pip',
-    '^python_dateutil',
-    '^jmespath',
-    '^s3transfer',
-    '^setuptools',
-    '^six',
-    '^urllib3',
+# absolute src_dir -> dict; see git_get_metadata()
+git_metadata_cache = dict()
+# frozenset of omit patterns -> tuple of compiled regexes; see compile_omit_patterns()
+omit_regex_cache = dict()
+# each thread's reusable buffer; see read_file_into_buffer()
+read_buffers = threading.local()
+# Exclude these projects by default, because AWS Lambda environment provides them
+deps_builtin_to_runtime = frozenset([
+    'boto3',
+    'botocore',
+    'dateutil',
+    'pip',
+    'python_dateutil',
+    'jmespath',
+    's3transfer',
+    'setuptools',
+    'six',
+    'urllib3',
 ])
+# ...as omit patterns for a lambda ZIP, where they're installed at the top level, and for a layer ZIP
+zip_omit = frozenset('^' + builtin_dep for builtin_dep in deps_builtin_to_runtime)
+layer_zip_omit = frozenset('^python/' + builtin_dep for builtin_dep in deps_builtin_to_runtime)
+
+class LocalDepResolver:
+    '''
+    Installs a project and its [lambda_zip] local_dependency projects, remembering what has already been
+    installed into each destination directory and caching each pyproject.toml it parses.
+
+    One resolver may be shared by several NewAwsLambdaZip / NewAwsLambdaLayerZip objects built in the same
+    process; nothing is kept in module globals.
+    '''
+    def __init__(self, build_isolation:bool = True):
+        # passed to invoke_pip_install(); see there
+        self.build_isolation = build_isolation
+        # (dst_dir, local_dep_dir) tuples of resolve()d Paths
+        self.installed = set()
+        # (resolve()d local_dep_dir, recursive) -> result of collect_local_deps()
+        self.local_deps_cache = dict()
+        # pyproject.toml path -> parsed data
+        self.toml_cache = dict()
+
+    def collect_local_deps(
+        self,
+        local_dep_dir:Path,
+        recursive:bool = True,
+        collected:list = None,
+        seen:set = None,
+    ) -> list:
+        '''
+        Read local_dep_dir/pyproject.toml and return a list of local_dep_dir and every directory given in
+        its [lambda_zip] local_dependency list, RECURSIVELY if recursive is set.  Dependencies come before
+        the projects that depend on them, and each directory appears only once.  local_dep_dir is last.
+
+        Directories are canonicalized with Path.resolve(), so one reached via different relative paths or
+        symlinks is still only collected once.  Each is marked seen before recursing into its dependencies,
+        which also stops dependency cycles from recursing forever.
+
+        Top-level results are memoized, because the lambda ZIP, the layer ZIP and --skip-unchanged all
+        ask about the same project.
+        '''
+        if collected == None:
+            cache_key = (Path(local_dep_dir).resolve(), recursive)
+            if cache_key not in self.local_deps_cache:
+                self.local_deps_cache[cache_key] = self.collect_local_deps(
+                    local_dep_dir = cache_key[0],
+                    recursive = recursive,
+                    collected = [],
+                    seen = set(),
+                )
+            return list(self.local_deps_cache[cache_key])
+        seen.add(local_dep_dir)
+        dep_data = self.load_pyproject_toml(local_dep_dir)
+        if 'lambda_zip' in dep_data and recursive:
+            for sub_dep in dep_data['lambda_zip'].get('local_dependency', []):
+                sub_dep_path = Path(local_dep_dir, sub_dep).resolve()
+                if sub_dep_path not in seen:
+                    # RECURSION HERE
+                    self.collect_local_deps(local_dep_dir=sub_dep_path, collected=collected, seen=seen)
+        collected.append(local_dep_dir)
+        return collected
+
+    def get_pre_resolved_requirements(self, local_dep_dir:Path):
+        '''
+        Return the path of the file named by [lambda_zip] pre_resolved_requirements in local_dep_dir's
+        pyproject.toml, relative to local_dep_dir, or None if it isn't set.  Lock files aren't picked up
+        just by their name; other tools' requirements.lock files may not suit `pip download --no-deps`.
+        '''
+        dep_data = self.load_pyproject_toml(local_dep_dir)
+        requirements_filename = dep_data.get('lambda_zip', {}).get('pre_resolved_requirements')
+        if requirements_filename == None:
+            return None
+        return Path(local_dep_dir, requirements_filename)
+
+    def get_zip_omit(self, local_dep_dir:Path, recursive:bool = True) -> frozenset:
+        '''
+        Return the [lambda_zip] zip_omit patterns of local_dep_dir and, if recursive, of all its local
+        dependencies; i.e. of exactly the projects install_to_dir() installs with the same arguments.
+        Other projects this resolver has read, e.g. while building another ZIP, don't contribute.
+        '''
+        retset = set()
+        for dep_dir in self.collect_local_deps(local_dep_dir=local_dep_dir, recursive=recursive):
+            dep_data = self.load_pyproject_toml(dep_dir)
+            retset.update(dep_data.get('lambda_zip', {}).get('zip_omit', []))
+        return frozenset(retset)
+
+    def install_to_dir(
+        self,
+        dst_dir:Path,
+        local_dep_dir:Path,
+        install_dependencies:bool = True,
+        pre_resolved_requirements:Path = None,
+    ):
+        '''
+        Call this method on the python source directory of your lambda; the directory containing
+        pyproject.toml.
+
+        local_dep_dir and, if install_dependencies, all of its local dependencies (see collect_local_deps())
+        are installed by ONE pip invocation, so we pay pip's startup & resolver cost once rather than once
+        per local dependency.  Local dependencies already installed into dst_dir are skipped.
+
+        If pre_resolved_requirements is given, or set in local_dep_dir's pyproject.toml (see
+        get_pre_resolved_requirements()), it must pin every third-party dependency.  Those are fetched as wheels with
+        `pip download --no-deps` and unpacked straight into dst_dir, and the local projects are then
+        installed with --no-deps, so pip's resolver never runs.
+        '''
+        logger.info(F'Installing local_dep_dir {local_dep_dir} to {dst_dir}')
+        local_deps = self.collect_local_deps(local_dep_dir=local_dep_dir, recursive=install_dependencies)
+        # collect_local_deps() resolve()s paths; the installed set has to compare like with like
+        dst_dir = Path(dst_dir).resolve()
+        local_dep_dir = local_deps[-1]
+        if install_dependencies and pre_resolved_requirements == None:
+            pre_resolved_requirements = self.get_pre_resolved_requirements(local_dep_dir)
+        if install_dependencies and pre_resolved_requirements != None:
+            pre_resolved_requirements = Path(pre_resolved_requirements).resolve()
+            if (dst_dir, pre_resolved_requirements) not in self.installed:
+                check_pre_resolved_requirements(pre_resolved_requirements)
+                logger.info(F'Installing pre-resolved requirements {pre_resolved_requirements} to {dst_dir}')
+                with TemporaryDirectory() as wheels_dir:
+                    invoke_pip_download(dest_dir=Path(wheels_dir), requirements_file=pre_resolved_requirements)
+                    for wheel_path in sorted(Path(wheels_dir).glob('*.whl')):
+                        unpack_wheel(wheel_path=wheel_path, dst_dir=dst_dir)
+                self.installed.add((dst_dir, pre_resolved_requirements))
+            pip_install_dependencies = False
+        else:
+            pip_install_dependencies = install_dependencies
+        # local_dep_dir itself is always last, and always installed
+        packages = [
+            sub_dep for sub_dep in local_deps[:-1]
+            if (dst_dir, sub_dep) not in self.installed
+        ]
+        packages.append(local_dep_dir)
+        invoke_pip_install(
+            target_dir=dst_dir,
+            packages=[str(package) for package in packages],
+            install_dependencies=pip_install_dependencies,
+            build_isolation=self.build_isolation,
+        )
+        for package in packages:
+            self.installed.add((dst_dir, package))
+
+    def load_pyproject_toml(self, local_dep_dir:Path) -> dict:
+        toml_path = Path(local_dep_dir, 'pyproject.toml')
+        if toml_path in self.toml_cache:
+            return self.toml_cache[toml_path]
+        try:
+            with open(toml_path, 'rb') as toml_file:
+                dep_data = tomllib.load(toml_file)
+        except Exception as e:
+            raise ValueError(F'Cannot open pyproject.toml in local_dependency directory {local_dep_dir}: {e}')
+        self.toml_cache[toml_path] = dep_data
+        return dep_data
 
 class NewAwsLambdaLayerZip:
     '''
@@ -58,28 +231,15 @@ class NewAwsLambdaLayerZip:
 
     '''
     boto3_lambda_client can be supplied by caller.
-    If not, we invoke boto3.client('lambda') to get one the first time we need it.
+    If not, we invoke get_boto3_client('lambda') to get one the first time we need it.
     '''
     boto3_lambda_client = None
     '''
     boto3_s3_client can be supplied by caller.
-    If not, we invoke boto3.client('s3') to get one the first time we need it.
+    If not, we invoke get_boto3_client('s3') to get one the first time we need it.
     '''
     boto3_s3_client = None
 
-    deps_builtin_to_runtime = set([
-        'boto3',
-        'botocore',
-        'dateutil',
-        'pip',
-        'python_dateutil',
-        'jmespath',
-        's3transfer',
-        'setuptools',
-        'six',
-        'urllib3',
-    ])
-
     layer_metadata_publish_fields = [
         'branch',
         'commit',
@@ -103,10 +263,16 @@ class NewAwsLambdaLayerZip:
         omit_projects:set = None,
         s3_url:urllib.parse.ParseResult = None,
         zip_filename:Path = None,
+        zip_compression:int = ZIP_STORED,
+        zip_compresslevel:int = None,
+        local_dep_resolver:LocalDepResolver = None,
     ):
         '''
         Note: If the given s3_url ends with '/', the layer name followed by '.zip' will be added to it.
         For example, s3://jeff-bucket/artifacts/ becomes s3://jeff-bucket/artifacts/my_layer.zip
+
+        local_dep_resolver may be shared with other objects built in the same process; if not given, a new
+        LocalDepResolver is used.
         '''
         # copy arguments to object
         self.name = name
@@ -116,6 +282,9 @@ class NewAwsLambdaLayerZip:
         self.omit_pathnames = set() if omit_pathnames == None else omit_pathnames
         self.omit_path_patterns = set() if omit_path_patterns == None else omit_path_patterns
         self.omit_projects = set() if omit_projects == None else omit_projects
+        self.zip_compression = zip_compression
+        self.zip_compresslevel = zip_compresslevel
+        self.local_dep_resolver = LocalDepResolver() if local_dep_resolver == None else local_dep_resolver
         if zip_filename == None:
             self.zip_filename = Path(self.src_dir.parent, self.name + '_layer.zip')
         else:
@@ -126,7 +295,7 @@ class NewAwsLambdaLayerZip:
         # install src_dir project(s) & dependencies into tmp_dir_for_layer + '/python'
         self.tmp_python_path = Path(self.tmp_dir_for_layer, 'python')
         self.tmp_python_path.mkdir(exist_ok=True, mode=0o755, parents=True)
-        install_to_dir(
+        self.local_dep_resolver.install_to_dir(
             dst_dir = self.tmp_python_path,
             local_dep_dir = self.src_dir
         )
@@ -138,17 +307,23 @@ class NewAwsLambdaLayerZip:
         for project_name in self.omit_projects:
             project_pattern = '^python/' + re.sub(r'[-_]+', '[-_]+', project_name)
             self.omit_project_patterns.add(project_pattern)
-        self.omit_patterns = self.omit_project_patterns | self.omit_path_patterns
-        for builtin_dep in self.deps_builtin_to_runtime:
-            self.omit_patterns.add('^python/' + builtin_dep)
+        self.omit_patterns = frozenset(self.omit_project_patterns | self.omit_path_patterns | layer_zip_omit)
+        self.omit_prefixes, self.omit_regexes = split_omit_patterns(self.omit_patterns)
+        self.omit_compiled_regexes = compile_omit_patterns(self.omit_regexes)
 
+        file_digests = dict()
         zf = create_zip_file(
             tmp_dir = self.tmp_dir_for_layer,
             zip_filename = self.zip_filename,
             zip_omit_exact_names = self.omit_pathnames,
-            zip_omit_patterns = self.omit_patterns,
+            zip_omit_prefixes = self.omit_prefixes,
+            zip_omit_regexes = self.omit_compiled_regexes,
+            compression = self.zip_compression,
+            compresslevel = self.zip_compresslevel,
+            file_digests = file_digests,
         )
         self.zip_namelist = zf.namelist()
+        zf.close()
 
         # Our hash digest is not a digest of the ZIP file itself.  We need a repeatable hash that solves
         # several problems:
@@ -156,34 +331,36 @@ class NewAwsLambdaLayerZip:
         #   2) `pip install --target <dir>` causes a unix timestamp encoded in `.pyc` header to be the current time
         #   3) `.zip` files themselves contain timestamps which would be the current build time
         #   4) want to add a file `lambda_zip_metadata.yml` later to include more build metadata
+        #
+        # Each file's SHA-256 is computed by create_zip_file() from the same read that feeds the ZIP, so
+        # no file is read twice.  The layer digest is the SHA-256 of every (filename, file digest) pair in
+        # sorted filename order.
+        #
+        # SHA-256 is deliberate.  The digest is published as `sha256b64` in each layer version's description
+        # and compared against existing versions for de-duplication, and hashlib's SHA-256 is hardware
+        # accelerated on current CPUs.  A faster third-party hash (e.g. BLAKE3) would add a compiled
+        # dependency for little gain now that hashing rides along with zipping.
         hasher = hashlib.sha256()
         for zipped_filename in sorted(self.zip_namelist):
             if zipped_filename.endswith('.pyc') or zipped_filename == 'lambda_zip_metadata.yml':
                 continue
-            hasher.update(bytes(zipped_filename, 'utf-8')) # include the filename itself in hashed content
-            with zf.open(zipped_filename) as zf_bin:
-                while True:
-                    buffer = zf_bin.read(1048576)
-                    if not buffer:
-                        break
-                    hasher.update(buffer)
+            # include the filename itself in hashed content
+            hasher.update(bytes(zipped_filename, 'utf-8') + b'\0' + file_digests[zipped_filename])
         self.sha256_b64digest = base64.b64encode(hasher.digest()).decode('utf-8')
         self.sha256_digest = hasher.digest()
         self.sha256_hexdigest = hasher.hexdigest()
 
-        zf.close()
-
         # get metadata which may be used later for S3 attributes & layer description
         self.update_metadata()
 
     def get_boto3_s3_client(self):
         if self.boto3_s3_client == None:
-            self.boto3_s3_client = boto3.client('s3')
+            self.boto3_s3_client = get_boto3_client('s3')
         return self.boto3_s3_client
 
     def get_boto3_lambda_client(self):
         if self.boto3_lambda_client == None:
-            self.boto3_lambda_client = boto3.client('lambda')
+            self.boto3_lambda_client = get_boto3_client('lambda')
         return self.boto3_lambda_client
 
     def encode_metadata_for_description(self):
@@ -196,7 +373,8 @@ class NewAwsLambdaLayerZip:
             self.update_metadata()
         description_metadata = self.metadata.copy()
         for field_name, max_len in self.layer_metadata_truncate_fields_to_length.items():
-            if len(description_metadata[field_name]) > max_len:
+            # e.g. there's no 'branch' when HEAD is detached
+            if field_name in description_metadata and len(description_metadata[field_name]) > max_len:
                 description_metadata[field_name] = description_metadata[field_name][0:max_len - 3] + '...'
         retstr = json.dumps(self.metadata, indent=None, separators=(',', ':'), sort_keys=True)
         return retstr
@@ -222,6 +400,13 @@ class NewAwsLambdaLayerZip:
         self.version = pub_response['Version']
         self.version_arn = pub_response['LayerVersionArn']
         logger.info(f"published new layer version {self.version} SHA-256 {self.metadata['sha256b64']}")
+        # only hash the ZIP file itself once it's actually published; de-duplicated builds never need it
+        code_sha256 = pub_response.get('Content', {}).get('CodeSha256')
+        if code_sha256 != None:
+            zip_sha256_b64digest = base64.b64encode(file_sha256_digest(self.zip_filename)).decode('utf-8')
+            if code_sha256 != zip_sha256_b64digest:
+                logger.error(f'Layer version {self.version} CodeSha256 {code_sha256} does not match the SHA-256 '+
+                             f'of {self.zip_filename} ({zip_sha256_b64digest}).  Was the S3 object replaced?')
         return self.layer_version_obj
 
     def s3_url_set(self, s3_url):
@@ -265,25 +450,20 @@ class NewAwsLambdaLayerZip:
             Bucket = self.s3_bucket,
             Key = self.s3_key,
             ExtraArgs = {'Metadata': metadata_stringified},
+            Config = get_s3_transfer_config(),
         )
         return result
 
 class NewAwsLambdaZip:
     '''
     Use this class to create a new lambda ZIP file.
+
+    If source_digest is given (see fast_source_digest()) it's saved in a file beside the ZIP.  When a later
+    build is given the same source_digest and the ZIP is still there, installing and zipping are skipped,
+    and the existing ZIP is used as-is.
     '''
-    deps_builtin_to_runtime = set([
-        'boto3',
-        'botocore',
-        'dateutil',
-        'pip',
-        'python_dateutil',
-        'jmespath',
-        's3transfer',
-        'setuptools',
-        'six',
-        'urllib3',
-    ])
+    # appended to zip_filename to name the file holding the source_digest the ZIP was built from
+    source_digest_suffix = '.sourcesha256b64'
 
     def __init__(
         self,
@@ -294,21 +474,47 @@ class NewAwsLambdaZip:
         omit_path_patterns:set = None,
         omit_projects:set = None,
         zip_filename:Path = None,
+        zip_compression:int = ZIP_STORED,
+        zip_compresslevel:int = None,
+        local_dep_resolver:LocalDepResolver = None,
+        source_digest:str = None,
+        stream_to = None,
     ):
         # copy arguments
         self.name = name
         self.src_dir = src_dir
         self.tmp_dir_for_lambda = tmp_dir_for_lambda
+        self.source_digest = source_digest
+        self.stream_to = stream_to
         # args with defaults
         self.install_dependencies = install_dependencies
         self.omit_path_patterns = set() if omit_path_patterns == None else omit_path_patterns
         self.omit_projects = set() if omit_projects == None else omit_projects
+        self.zip_compression = zip_compression
+        self.zip_compresslevel = zip_compresslevel
+        self.local_dep_resolver = LocalDepResolver() if local_dep_resolver == None else local_dep_resolver
         if zip_filename == None:
             self.zip_filename = Path(self.src_dir.parent, self.src_dir.name + '.zip')
         else:
             self.zip_filename = zip_filename
+        source_digest_path = Path(str(self.zip_filename) + self.source_digest_suffix)
+
+        self.reused = False
+        if self.source_digest != None and self.zip_filename.is_file():
+            try:
+                with open(source_digest_path) as source_digest_file:
+                    self.reused = source_digest_file.read().strip() == self.source_digest
+            except FileNotFoundError:
+                pass
+        if self.reused:
+            logger.info(F'Reusing {self.zip_filename}; it was built from identical source')
+            with ZipFile(self.zip_filename, 'r') as zf:
+                self.zip_namelist = zf.namelist()
+            return
+        # a stale digest must not outlive the ZIP it described if this build fails part-way
+        source_digest_path.unlink(missing_ok=True)
 
-        install_to_dir(
+        self.local_dep_resolver.install_to_dir(
             dst_dir = self.tmp_dir_for_lambda,
             install_dependencies = self.install_dependencies,
             local_dep_dir = self.src_dir
@@ -319,16 +525,50 @@ class NewAwsLambdaZip:
         for project_name in self.omit_projects:
             project_pattern = '^' + re.sub(r'[-_]+', '[-_]+', project_name)
             self.omit_project_patterns.add(project_pattern)
-        self.omit_patterns = self.omit_project_patterns | self.omit_path_patterns
-        for builtin_dep in self.deps_builtin_to_runtime:
-            self.omit_patterns.add('^' + builtin_dep)
+        # also omit the zip_omit lists from pyproject.toml of the projects installed, and builtin deps.
+        # Install is finished, so the omit list is frozen and compiled once here, before zipping starts.
+        self.omit_patterns = frozenset(
+            self.omit_project_patterns
+            | self.omit_path_patterns
+            | self.local_dep_resolver.get_zip_omit(
+                local_dep_dir = self.src_dir,
+                recursive = self.install_dependencies,
+            )
+            | zip_omit
+        )
+        self.omit_prefixes, self.omit_regexes = split_omit_patterns(self.omit_patterns)
+        self.omit_compiled_regexes = compile_omit_patterns(self.omit_regexes)
 
         zf = create_zip_file(
             tmp_dir = self.tmp_dir_for_lambda,
             zip_filename = self.zip_filename,
-            zip_omit_patterns = self.omit_patterns,
+            zip_omit_prefixes = self.omit_prefixes,
+            zip_omit_regexes = self.omit_compiled_regexes,
+            compression = self.zip_compression,
+            compresslevel = self.zip_compresslevel,
+            stream_to = self.stream_to,
         )
         self.zip_namelist = zf.namelist()
+        zf.close()
+        if self.source_digest != None:
+            with open(source_digest_path, 'w') as source_digest_file:
+                source_digest_file.write(self.source_digest + '\n')
+
+class TeeWriter:
+    '''
+    Write-only, unseekable file-like object which passes everything written to it on to each of files.
+    '''
+    def __init__(self, *files):
+        self.files = files
+
+    def flush(self):
+        for file in self.files:
+            file.flush()
+
+    def write(self, data) -> int:
+        for file in self.files:
+            file.write(data)
+        return len(data)
 
 def aws_lambda_update(
     function_name:str,
@@ -346,7 +586,7 @@ def aws_lambda_update(
     Lambdas become "busy" for a while after each update.  Repeated updates can result in a ResourceConflictException
     from the AWS API.  If this happens, we retry until timeout seconds have elapsed.
     '''
-    lam = boto3.client('lambda')
+    lam = get_boto3_client('lambda')
     time_initial = time.time()
     time_deadline = time_initial + timeout
 
@@ -399,65 +639,321 @@ def aws_lambda_update(
         logger.critical('No more retries.  Failed to update lambda code.')
         raise RuntimeError('No more retries.  Failed to update lambda code.')
 
+def check_pre_resolved_requirements(requirements_file:Path):
+    '''
+    Raise ValueError if requirements_file has lines `pip download --no-deps --only-binary :all:` can't
+    satisfy: editable (-e) requirements, or local paths and file: URLs.  Local projects belong in
+    [lambda_zip] local_dependency instead.
+    '''
+    with open(requirements_file) as requirements:
+        for line_number, line in enumerate(requirements, start=1):
+            requirement = line.split(' #', 1)[0].strip()
+            if (
+                requirement.startswith(('-e', '--editable', '.', '/', 'file:'))
+                or re.search(r'@\s*file:', requirement)
+            ):
+                raise ValueError(
+                    f'{requirements_file} line {line_number}: {requirement!r} is editable or a local path, '+
+                    'which pre-resolved requirements cannot install.  Use [lambda_zip] local_dependency for '+
+                    'local projects.'
+                )
+
+def compile_omit_patterns(patterns:set) -> tuple:
+    '''
+    Compile patterns into a tuple of compiled regexes for search_omit_regexes().  Returns an empty tuple
+    if there are no patterns.
+
+    Each pattern is compiled on its own first, so a bad one raises re.error just as it always has.  Those
+    which don't depend on being a whole regex by themselves are then fused into one alternation, so each
+    path costs a single regex search rather than one per pattern.  Patterns with inline global flags like
+    `(?i)`, named groups, backreferences or conditionals are kept as separate regexes.
+
+    Results are cached in omit_regex_cache, keyed by the frozenset of patterns, so building several
+    ZIPs with the same omit list compiles it only once.
+    '''
+    cache_key = frozenset(patterns)
+    if cache_key not in omit_regex_cache:
+        default_flags = re.compile('').flags
+        fusable = []
+        retlist = []
+        for pattern in sorted(cache_key):
+            compiled = re.compile(pattern)
+            if (
+                compiled.flags != default_flags
+                or compiled.groupindex
+                or re.search(r'\\[1-9]|\(\?P=|\(\?\(', pattern)
+            ):
+                retlist.append(compiled)
+            else:
+                fusable.append(pattern)
+        if len(fusable) == 1:
+            retlist.insert(0, re.compile(fusable[0]))
+        elif fusable:
+            retlist.insert(0, re.compile('|'.join(f'(?:{pattern})' for pattern in fusable)))
+        omit_regex_cache[cache_key] = tuple(retlist)
+    return omit_regex_cache[cache_key]
+
 def create_zip_file(
     tmp_dir:Path,
     zip_filename:Path,
     zip_omit_exact_names:set = None,
     zip_omit_patterns:set = None,
+    compression:int = ZIP_STORED,
+    compresslevel:int = None,
+    zip_omit_prefixes:tuple = None,
+    omit_bytecode:bool = True,
+    stream_to = None,
+    file_digests:dict = None,
+    zip_omit_regexes:tuple = None,
 ):
     '''
     Create the lambda .zip file using tmp_dir as the source, and excluding any file pathnames
-    matching the zip_omit_patterns.
+    matching the zip_omit_patterns or starting with one of the zip_omit_prefixes.  See
+    split_omit_patterns() for turning plain `^prefix` patterns into zip_omit_prefixes.
+
+    Instead of zip_omit_patterns, callers may pass zip_omit_regexes, already built by
+    compile_omit_patterns(), so the patterns aren't even looked up in the compile cache again.
+
+    If omit_bytecode is set, `.pyc` files and anything in `__pycache__` directories are left out as well.
+    pip bakes the tmp_dir path and install time into them, so they're not reproducible, and they often
+    make up a third of the files in a dependency tree.
+
+    compression and compresslevel are passed through to ZipFile.  ZIP_STORED is the default here because
+    it's by far the fastest for large dependency trees.  The CLI defaults to ZIP_DEFLATED with
+    compresslevel=1 (see --compress-level), which is nearly as small as the default level 6 and much faster.
 
     Path names in the output zip file will be like e.g.: acme_dep_name/__init__.py
 
-    NOTE: We chdir(tmp_dir) because the Python ZipFile module doesn't allow us to specify the
-    path of files added to the archive.  If we didn't, the zip file would contain garbage paths
-    like /var/tmp/hlaghlag/acme_dep_name/__init__.py
+    Entries are written in sorted order and all carry the same 1980-01-01 timestamp, so the ZIP's bytes
+    depend only on the names, modes and contents of the files -- not on when pip installed them.
+
+    If stream_to is given, e.g. an S3MultipartUpload, every byte of the ZIP is also written to it as the ZIP
+    is built.  Members are then written with their sizes and CRC up front, as usual, except files of
+    4 MiB or more, which get a data descriptor since the output can't be seeked back over.
+
+    If file_digests is given, it's filled in with the SHA-256 digest of each zipped file's contents, keyed
+    by the name it has in the ZIP.  They're computed from the same read that feeds the ZIP.
+
+    Returns the ZipFile the ZIP was written with, already closed.  Its namelist() and infolist() still
+    describe every member, so callers don't have to re-open zip_filename and parse its central directory
+    again just to learn what went in.  Calling close() on it again is harmless.
+
+    Each file is added with an arcname relative to tmp_dir, so the zip file doesn't contain garbage
+    paths like /var/tmp/hlaghlag/acme_dep_name/__init__.py.  We don't chdir(), so this is safe to run
+    from several threads at once.
     '''
     logger.info(F'Creating ZIP file {zip_filename} from tmp_dir {str(tmp_dir)}')
-    os.chdir(tmp_dir)
     omitted_file_count = 0
     zipped_file_count = 0
 
-    zip_omit_exact_names = set() if zip_omit_exact_names == None else zip_omit_exact_names
+    zip_omit_exact_names = set() if zip_omit_exact_names == None else set(zip_omit_exact_names)
     zip_omit_patterns = set() if zip_omit_patterns == None else zip_omit_patterns
+    zip_omit_prefixes = tuple() if zip_omit_prefixes == None else tuple(zip_omit_prefixes)
 
-    zip_omit_compiled_regexes = set()
-    for pattern in zip_omit_patterns:
-        compiled = re.compile(pattern)
-        zip_omit_compiled_regexes.add(compiled)
-    
-    zf = ZipFile(zip_filename, 'w')
-    for relative_path, subdirs, files in os.walk(Path()):
-        for file_name in files:
-            file_relative_path = Path(relative_path, file_name)
-            omitted = 0
-            for exact_name in zip_omit_exact_names:
-                if exact_name == str(file_relative_path):
-                    logger.debug(f'Omitting {file_relative_path} matching omit-exact-name')
-                    omitted_file_count += 1
-                    omitted = 1
-                    break
-            if omitted:
-                continue
-            for regex in zip_omit_compiled_regexes:
-                if regex.search(str(file_relative_path)):
-                    logger.debug(F'Omitting {file_relative_path} matching omit-regex {{regex}}')
-                    omitted_file_count += 1
-                    break
+    if zip_omit_regexes != None:
+        if zip_omit_patterns:
+            raise ValueError('create_zip_file() takes zip_omit_patterns or zip_omit_regexes, not both')
+    else:
+        zip_omit_regexes = compile_omit_patterns(zip_omit_patterns)
+
+    # The ZIP is built in memory (spilling to the system temp dir if it's large) and copied to zip_filename
+    # once complete.  Writing ZipFile's many small records straight to a network or overlay filesystem,
+    # as CI runners often have, can be dramatically slower.  When streaming, output is strictly sequential
+    # so a large write buffer on zip_filename does the same job.
+    if stream_to == None:
+        spool_file = SpooledTemporaryFile(max_size=64 * 1024 * 1024, mode='w+b')
+        zip_output = spool_file
+    else:
+        zip_file = open(zip_filename, 'wb', buffering=4 * 1024 * 1024)
+        zip_output = TeeWriter(zip_file, stream_to)
+    zf = ZipFile(
+        zip_output,
+        'w',
+        compression = compression,
+        compresslevel = compresslevel,
+        allowZip64 = True,
+        strict_timestamps = False,
+    )
+    # Files smaller than this are read in one call and added with writestr(); bigger ones are streamed
+    writestr_max_size = 256 * 1024
+    zip_date_time = (1980, 1, 1, 0, 0, 0)
+    pycache_component = '/__pycache__/'
+    # Files at least this big are always streamed through ZipFile rather than compressed whole in memory
+    compress_in_memory_max_size = 4 * 1024 * 1024
+    compress_max_workers = os.cpu_count() or 1
+    # Limits on files handed to the thread pool but not yet written out.  Each holds its whole compressed
+    # (or, for ZIP_STORED, copied) data in memory until it's written.
+    compress_in_flight_max_files = compress_max_workers * 16
+    compress_in_flight_max_size = 64 * 1024 * 1024
+    # zip_compress_file() only knows these; anything else, e.g. ZIP_BZIP2, is left to ZipFile
+    compress_in_memory = compression in (ZIP_DEFLATED, ZIP_STORED)
+    want_digest = file_digests != None
+    zip_entries = []
+    for str_path in sorted(iter_dir_files(str(tmp_dir))):
+        if omit_bytecode and (str_path.endswith('.pyc') or pycache_component in '/' + str_path):
+            omitted_file_count += 1
+            continue
+        if str_path in zip_omit_exact_names:
+            logger.debug(f'Omitting {str_path} matching omit-exact-name')
+            omitted_file_count += 1
+            continue
+        if str_path.startswith(zip_omit_prefixes):
+            logger.debug(f'Omitting {str_path} matching omit-prefix')
+            omitted_file_count += 1
+            continue
+        if zip_omit_regexes and (rem := search_omit_regexes(zip_omit_regexes, str_path)):
+            logger.debug(F'Omitting {str_path} matching omit-regex at {rem.group(0)!r}')
+            omitted_file_count += 1
+            continue
+        full_path = os.path.join(tmp_dir, str_path)
+        # every entry gets zip_date_time, so a source mtime outside what ZIP can store (before 1980, as
+        # from SOURCE_DATE_EPOCH=0 builds, or after 2107) mustn't make from_file() raise
+        zinfo = ZipInfo.from_file(full_path, arcname=str_path, strict_timestamps=False)
+        zinfo.date_time = zip_date_time
+        zinfo.compress_type = compression
+        zip_entries.append((full_path, zinfo))
+
+    if compression == ZIP_DEFLATED or not zf._seekable:
+        # Deflate is the CPU-bound part of the build.  zlib releases the GIL while compressing, so files are
+        # compressed on a thread pool and the already-compressed data is written, in order, from this thread.
+        # Files are only submitted while the in-flight limits allow, which bounds the memory used, however
+        # large the files are.
+        in_flight = deque()
+        in_flight_size = 0
+
+        def write_oldest_in_flight():
+            nonlocal in_flight_size
+            full_path, zinfo, future = in_flight.popleft()
+            if future == None:
+                file_digest = zip_write_file(zf, zinfo, full_path, compresslevel, writestr_max_size, want_digest)
             else:
-                # if no regex match happened during the for loop, add file to the zipfile
-                zf.write(str(file_relative_path))
-                zipped_file_count += 1
+                crc, file_size, compressed, file_digest = future.result()
+                zip_write_compressed(zf, zinfo, crc, file_size, compressed)
+                in_flight_size -= zinfo.file_size
+            if want_digest:
+                file_digests[zinfo.filename] = file_digest
+
+        with ThreadPoolExecutor(max_workers=compress_max_workers) as executor:
+            for full_path, zinfo in zip_entries:
+                if compress_in_memory and zinfo.file_size < compress_in_memory_max_size:
+                    while in_flight and (
+                        len(in_flight) >= compress_in_flight_max_files
+                        or in_flight_size + zinfo.file_size > compress_in_flight_max_size
+                    ):
+                        write_oldest_in_flight()
+                    future = executor.submit(zip_compress_file, full_path, compression, compresslevel, want_digest)
+                    in_flight_size += zinfo.file_size
+                else:
+                    # streamed from this thread when its turn comes
+                    future = None
+                in_flight.append((full_path, zinfo, future))
+            while in_flight:
+                write_oldest_in_flight()
+    else:
+        for full_path, zinfo in zip_entries:
+            file_digest = zip_write_file(zf, zinfo, full_path, compresslevel, writestr_max_size, want_digest)
+            if want_digest:
+                file_digests[zinfo.filename] = file_digest
+    zipped_file_count = len(zip_entries)
+    zf.close()
+    if stream_to == None:
+        spool_file.seek(0)
+        with open(zip_filename, 'wb') as zip_file:
+            shutil.copyfileobj(spool_file, zip_file, 4 * 1024 * 1024)
+        spool_file.close()
+    else:
+        zip_file.close()
     logger.info(F'Created ZIP containing {zipped_file_count} files.  Omitted {omitted_file_count} regex matches.')
     return zf
 
 def emit_metadata_yaml(dst_yaml_path:Path, metadata:dict):
-    'Write given metadata dict to dst_yaml_file'
+    '''
+    Write given metadata dict to dst_yaml_file.
+
+    It's written as JSON, which any YAML 1.2 parser (e.g. yaml.safe_load()) reads just the same.  The json
+    module is much faster than PyYAML and saves lambda-zip depending on PyYAML at all.
+    '''
     logger.debug(F'Writing metadata to YAML file {str(dst_yaml_path)}')
     with open(dst_yaml_path, 'w') as yaml_file:
-        yaml.safe_dump(metadata, yaml_file, indent=4)
+        json.dump(metadata, yaml_file, indent=4, sort_keys=True)
+        yaml_file.write('\n')
+
+def fast_source_digest(
+    src_dirs:list,
+    build_options:dict = None,
+    base_dir:Path = None,
+    exclude_paths:set = None,
+) -> str:
+    '''
+    Return a base64 SHA-256 over the contents of the given source directories plus build_options, without
+    installing or zipping anything.  If this matches the digest recorded when a ZIP was last uploaded,
+    rebuilding would produce the same ZIP -- as long as third-party dependencies are pinned.
+
+    Each directory's path is hashed relative to base_dir, which defaults to the last of src_dirs (the top
+    project, as collect_local_deps() returns them).  The same source checked out somewhere else, e.g. in
+    another CI workspace, gets the same digest.
+
+    VCS metadata, bytecode caches and setuptools' build/ and *.egg-info output are ignored.  Symlinks,
+    including dangling ones and links to directories, are hashed by their target path rather than
+    followed.  Anything else that isn't a regular file, like a FIFO or socket, is skipped.
+
+    Files and directories in exclude_paths are skipped too.  These are build outputs which may sit inside a
+    source directory, e.g. the ZIP itself; hashing them would make every build's digest differ from the last.
+    '''
+    base_dir = Path(src_dirs[-1] if base_dir == None else base_dir).resolve()
+    exclude_paths = set() if exclude_paths == None else set(os.path.realpath(path) for path in exclude_paths)
+    hasher = hashlib.sha256()
+    hasher.update(bytes(json.dumps(build_options, sort_keys=True, default=str), 'utf-8'))
+    relative_src_dirs = sorted(
+        (os.path.relpath(Path(src_dir).resolve(), base_dir), str(src_dir)) for src_dir in src_dirs
+    )
+    for relative_src_dir, src_dir in relative_src_dirs:
+        hasher.update(b'\0' + bytes(relative_src_dir, 'utf-8') + b'\0')
+        for dir_path, subdirs, files in os.walk(src_dir):
+            subdirs[:] = sorted(
+                subdir for subdir in subdirs
+                if not (
+                    subdir in ('.git', '__pycache__')
+                    or subdir.endswith('.egg-info')
+                    or (subdir == 'build' and dir_path == src_dir)
+                    or os.path.join(dir_path, subdir) in exclude_paths
+                )
+            )
+            # os.walk() doesn't descend into symlinked directories, but where they point still matters
+            symlinked_subdirs = [subdir for subdir in subdirs if os.path.islink(os.path.join(dir_path, subdir))]
+            for file_name in sorted(files + symlinked_subdirs):
+                file_path = os.path.join(dir_path, file_name)
+                if file_path in exclude_paths:
+                    continue
+                relative_path = os.path.relpath(file_path, src_dir)
+                file_mode = os.lstat(file_path).st_mode
+                if stat.S_ISLNK(file_mode):
+                    file_digest = b'l' + bytes(os.readlink(file_path), 'utf-8')
+                elif stat.S_ISREG(file_mode):
+                    file_digest = b'f' + file_sha256_digest(file_path)
+                else:
+                    continue
+                hasher.update(bytes(relative_path, 'utf-8') + b'\0' + file_digest + b'\0')
+    return base64.b64encode(hasher.digest()).decode('utf-8')
+
+def file_sha256_digest(file_path:Path) -> bytes:
+    '''
+    Return the SHA-256 digest of the contents of file_path.
+
+    Files of at least mmap_min_size bytes are memory-mapped and handed to hashlib in one update() call,
+    which hashes the whole file in C with the GIL released.  Smaller files are just read, into a reused
+    buffer; for them the mmap setup costs more than it saves.
+    '''
+    mmap_min_size = 65536
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb', buffering=0) as src_bin:
+        file_size = os.fstat(src_bin.fileno()).st_size
+        if file_size >= mmap_min_size:
+            with mmap.mmap(src_bin.fileno(), 0, access=mmap.ACCESS_READ) as src_mmap:
+                hasher.update(src_mmap)
+        elif file_size > 0:
+            hasher.update(read_file_into_buffer(src_bin))
+    return hasher.digest()
 
 def get_builder_metadata():
     retdict = {}
@@ -466,14 +962,17 @@ def get_builder_metadata():
     retdict['user'] = getpass.getuser()
     return retdict
 
-def get_pip_version(pip_command:str='pip'):
-    args = pip_command + ' --version'
-    logger.debug(F'Invoking pip --version command: {args}')
+def get_pip_version(pip_command:list=None):
+    '''
+    pip_command defaults to running pip as a module of the current Python interpreter.
+    '''
+    pip_command = [sys.executable, '-m', 'pip'] if pip_command == None else pip_command
+    args = [*pip_command, '--version']
+    logger.debug(F'Invoking pip --version command: {shlex.join(args)}')
     subp_result = subprocess.run(
         args = args,
         capture_output = True,
         check = True,
-        shell = True,
         stdin = subprocess.DEVNULL,
     )
     subp_stdout = subp_result.stdout.decode('utf-8')
@@ -483,104 +982,198 @@ def get_pip_version(pip_command:str='pip'):
         return retstr
     raise ValueError(f'Unable to match pip version in output from {args}: {subp_stdout}')
 
+def get_s3_transfer_config():
+    '''
+    S3 TransferConfig used for uploading ZIPs.  Layer ZIPs are often tens of MiB or more; uploading them
+    as multipart with many parts in flight keeps the connection busy rather than waiting on each PUT.
+    ZIPs under 16 MiB go up in a single PUT, where per-part request overhead would outweigh parallelism.
+    '''
+    from boto3.s3.transfer import TransferConfig
+    mib = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold = 16 * mib,
+        multipart_chunksize = 16 * mib,
+        max_concurrency = 16,
+        use_threads = True,
+    )
+
 def git_get_metadata(src_dir:Path):
     '''
     Retrieve a selection of metadata from git repo at src_dir.
+
+    Everything comes from one `git status --porcelain=v2 --branch --untracked-files=all` and one
+    `git describe`, so the work tree is only walked once.  'untracked' counts every untracked file, not
+    just the top untracked directory, as GitPython's untracked_files did.  Results are memoized per
+    directory, since both the lambda ZIP and the layer want them.  If there's no git executable, fall
+    back to git_read_head().
     '''
-    retdict = {}
-    repo = git.Repo(src_dir, search_parent_directories=True)
-    try:
-        retdict['branch'] = repo.active_branch.name
-    except:
-        pass
-    retdict['commit'] = repo.head.commit.hexsha
-    try:
-        retdict['describe'] = repo.git.describe(always=True, dirty=True)
-    except:
-        pass
-    retdict['dirty'] = repo.is_dirty()
-    retdict['untracked'] = len(repo.untracked_files)
+    cache_key = os.path.abspath(src_dir)
+    if cache_key not in git_metadata_cache:
+        try:
+            status_result = subprocess.run(
+                args = ['git', '-C', str(src_dir), 'status', '--porcelain=v2', '--branch', '--untracked-files=all'],
+                capture_output = True,
+                check = True,
+                stdin = subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            logger.warning('No git executable found; git metadata will not say whether the work tree is dirty')
+            git_metadata_cache[cache_key] = git_read_head(src_dir)
+            return dict(git_metadata_cache[cache_key])
+        retdict = {}
+        dirty = False
+        untracked = 0
+        for line in status_result.stdout.decode('utf-8').splitlines():
+            if line.startswith('# branch.oid '):
+                oid = line[len('# branch.oid '):]
+                if oid != '(initial)':
+                    retdict['commit'] = oid
+            elif line.startswith('# branch.head '):
+                head = line[len('# branch.head '):]
+                if head != '(detached)':
+                    retdict['branch'] = head
+            elif line.startswith('? '):
+                untracked += 1
+            elif line[0:2] in ('1 ', '2 ', 'u '):
+                dirty = True
+        describe_result = subprocess.run(
+            args = ['git', '-C', str(src_dir), 'describe', '--always', '--dirty'],
+            capture_output = True,
+            stdin = subprocess.DEVNULL,
+        )
+        if describe_result.returncode == 0:
+            retdict['describe'] = describe_result.stdout.decode('utf-8').strip()
+        retdict['dirty'] = dirty
+        retdict['untracked'] = untracked
+        git_metadata_cache[cache_key] = retdict
+    return dict(git_metadata_cache[cache_key])
+
+def git_read_head(src_dir:Path) -> dict:
+    '''
+    Read the branch and commit straight from the HEAD of the git repo containing src_dir, for hosts without
+    a git executable.  Returns the same keys as git_get_metadata(), so e.g. layer descriptions keep the same
+    fields.  'describe' is the abbreviated commit, as `git describe --always` gives when there are no tags.
+    Whether the work tree is dirty can't be known without git, so 'dirty' and 'untracked' are None.
+    '''
+    retdict = {'dirty': None, 'untracked': None}
+    src_dir = Path(src_dir).resolve()
+    for candidate_dir in [src_dir, *src_dir.parents]:
+        git_dir = Path(candidate_dir, '.git')
+        if git_dir.is_dir():
+            break
+        if git_dir.is_file():
+            # worktrees and submodules have a .git file pointing to the real git dir
+            gitdir_line = git_dir.read_text().strip()
+            if gitdir_line.startswith('gitdir: '):
+                git_dir = Path(candidate_dir, gitdir_line[len('gitdir: '):])
+                break
+    else:
+        raise FileNotFoundError(f'No git repo found at {src_dir} or any parent directory')
+    head = Path(git_dir, 'HEAD').read_text().strip()
+    if not head.startswith('ref: '):
+        retdict['commit'] = head
+    else:
+        ref_name = head[len('ref: '):]
+        if ref_name.startswith('refs/heads/'):
+            retdict['branch'] = ref_name[len('refs/heads/'):]
+        # a worktree's branches live in the main repo's git dir
+        common_dir = git_dir
+        if Path(git_dir, 'commondir').is_file():
+            common_dir = Path(git_dir, Path(git_dir, 'commondir').read_text().strip())
+        ref_path = Path(common_dir, ref_name)
+        if ref_path.is_file():
+            retdict['commit'] = ref_path.read_text().strip()
+        elif Path(common_dir, 'packed-refs').is_file():
+            with open(Path(common_dir, 'packed-refs')) as packed_refs:
+                for line in packed_refs:
+                    if line.rstrip('\n').endswith(' ' + ref_name):
+                        retdict['commit'] = line.split(' ', 1)[0]
+                        break
+    if 'commit' in retdict:
+        retdict['describe'] = retdict['commit'][0:7]
     return retdict
 
-def install_to_dir(
-    dst_dir:Path,
-    local_dep_dir:Path,
-    install_dependencies:bool = True,
-):
+def invoke_pip_download(
+    dest_dir:Path,
+    requirements_file:Path,
+    pip_command:list=None,
+) -> dict:
     '''
-    Call this function on the python source directory of your lambda; the directory containing
-    pyproject.toml.
-    
-    This function is used RECURSIVELY to resolve dependencies.  As those
-    are installed, local_deps_already_installed and pip_deps_already_installed
-    are populated, indicating which deps have already been satisfied.
-    '''
-    global local_deps_already_installed
-    global zip_omit
-    logger.info(F'Installing local_dep_dir {local_dep_dir} to {dst_dir}')
-    toml_path = Path(local_dep_dir, 'pyproject.toml')
-    try:
-        toml_file = open(toml_path)
-        toml_blob = toml_file.read()
-        dep_data = toml.loads(toml_blob)
-    except Exception as e:
-        raise ValueError(F'Cannot open pyproject.toml in local_dependency directory {local_dep_dir}: {e}')
-    if 'lambda_zip' in dep_data:
-        for omit_regex in dep_data['lambda_zip'].get('zip_omit', []):
-            zip_omit.add(omit_regex)
-        if install_dependencies:
-            sub_deps = set()
-            for sub_dep in dep_data['lambda_zip'].get('local_dependency', []):
-                sub_dep_path = Path(local_dep_dir, sub_dep).absolute()
-                sub_deps.add(sub_dep_path)
-            sub_deps_unresolved = sub_deps - local_deps_already_installed
-            for sub_dep in sub_deps_unresolved:
-                # RECURSION HERE
-                install_to_dir(dst_dir=dst_dir, local_dep_dir=sub_dep)
-                local_deps_already_installed.add(str(sub_dep))
-    # install local_dep_dir
-    invoke_pip_install(
-        target_dir=dst_dir,
-        packages=[str(local_dep_dir)],
-        install_dependencies=install_dependencies,
+    Wrapper around `pip download --no-deps --only-binary :all: -r <requirements_file> -d <dest_dir>`
+
+    Only wheels are downloaded, so they can be unpacked with unpack_wheel() rather than built.
+    '''
+    retdict = {}
+    pip_command = [sys.executable, '-m', 'pip'] if pip_command == None else pip_command
+    args = [
+        *pip_command,
+        'download',
+        '--disable-pip-version-check',
+        '--no-deps',
+        '--only-binary', ':all:',
+        '--requirement', str(requirements_file),
+        '--dest', str(dest_dir),
+    ]
+    logger.info(F'Invoking pip command: {shlex.join(args)}')
+    subp_result = subprocess.run(
+        args = args,
+        capture_output = True,
+        check = True,
+        stdin = subprocess.DEVNULL,
     )
-    local_deps_already_installed.add(str(local_dep_dir))
+    retdict['subprocess_result'] = subp_result
+    return retdict
 
 def invoke_pip_install(
     target_dir:Path,
     packages:list,
     install_dependencies:bool,
     dry_run:bool=False,
-    pip_command:str='pip',
+    pip_command:list=None,
     report:bool=False,
+    compile_bytecode:bool=False,
+    build_isolation:bool=True,
 ) -> dict:
     '''
     Wrapper around `pip install --target <target_dir> <packages>`
+
+    pip_command defaults to running pip as a module of the current Python interpreter.  It's invoked
+    without a shell, so package paths need no quoting.
+
+    Unless compile_bytecode is set, pip is told not to write `.pyc` files, which create_zip_file() leaves
+    out of the ZIP anyway.
+
+    Clearing build_isolation passes --no-build-isolation, which saves creating a fresh build environment for
+    each local project, but requires their build backends (e.g. setuptools) to be installed already.
     '''
     retdict = {}
+    pip_command = [sys.executable, '-m', 'pip'] if pip_command == None else pip_command
     dry_run_option = ['--dry-run'] if dry_run else []
     no_deps_option = [] if install_dependencies else ['--no-deps']
-    packages_str = ' '.join(packages)
+    no_compile_option = [] if compile_bytecode else ['--no-compile']
+    no_build_isolation_option = [] if build_isolation else ['--no-build-isolation']
     if report:
         report_path = Path(target_dir, 'lambda_zip_pip_report.json')
         report_option = ['--report', str(report_path)]
     else:
         report_option = []
-    args = ' '.join([
-        pip_command,
+    args = [
+        *pip_command,
         'install',
+        '--disable-pip-version-check',
         *dry_run_option,
         *no_deps_option,
+        *no_compile_option,
+        *no_build_isolation_option,
         *report_option,
         '--target', str(target_dir),
-        packages_str,
-    ])
-    logger.info(F'Invoking pip command: {args}')
+        *packages,
+    ]
+    logger.info(F'Invoking pip command: {shlex.join(args)}')
     subp_result = subprocess.run(
         args = args,
         capture_output = True,
         check = True,
-        shell = True,
         stdin = subprocess.DEVNULL,
     )
     retdict['subprocess_result'] = subp_result
@@ -593,6 +1186,70 @@ def invoke_pip_install(
 
     return retdict
 
+def iter_dir_files(dir_path:str):
+    '''
+    Yield the path of every regular file below dir_path, relative to dir_path and '/'-separated as
+    ZIP member names are.
+
+    This uses os.scandir() directly because DirEntry.is_dir() / is_file() are answered from the directory
+    listing on most platforms, saving a stat() per entry compared to os.walk().  Directories are walked
+    with an explicit stack rather than recursion, and paths are built as plain strings.  Like os.walk(),
+    symlinks to directories are not followed.
+    '''
+    dir_stack = [('', dir_path)]
+    while dir_stack:
+        relative_prefix, scan_path = dir_stack.pop()
+        with os.scandir(scan_path) as dir_entries:
+            for entry in dir_entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_stack.append((relative_prefix + entry.name + '/', entry.path))
+                elif entry.is_file():
+                    yield relative_prefix + entry.name
+
+def read_file_into_buffer(src_file) -> memoryview:
+    '''
+    Read the rest of src_file, a file opened in binary mode, and return a memoryview of the data.
+
+    Files up to 4 MiB, i.e. nearly everything in a dependency tree, are read into a buffer kept per
+    thread and re-used for the next file, rather than into a new bytes object each time.  The view is
+    only valid until the same thread calls this again, so copy it with bytes() if it must be kept.
+    '''
+    reuse_max_size = 4 * 1024 * 1024
+    read_size = os.fstat(src_file.fileno()).st_size - src_file.tell()
+    if read_size > reuse_max_size:
+        buffer = bytearray(read_size)
+    else:
+        buffer = getattr(read_buffers, 'buffer', None)
+        if buffer == None:
+            buffer = read_buffers.buffer = bytearray(reuse_max_size)
+    view = memoryview(buffer)
+    bytes_read = 0
+    while bytes_read < read_size and (chunk_size := src_file.readinto(view[bytes_read:read_size])):
+        bytes_read += chunk_size
+    return view[:bytes_read]
+
+def s3_get_object_metadata(s3_url:str) -> dict:
+    '''
+    Return the user metadata of the S3 object at s3_url, or an empty dict if there is no such object.
+
+    Without s3:ListBucket permission, S3 answers 403 rather than 404 for a missing object, so 403 is taken
+    as no object too.  If it really is a permissions problem, the upload that follows will report it.
+    '''
+    import botocore.exceptions
+    s3_url = urllib.parse.urlparse(s3_url)
+    s3 = get_boto3_client('s3')
+    try:
+        response = s3.head_object(Bucket=s3_url.hostname, Key=s3_url.path.lstrip('/'))
+    except botocore.exceptions.ClientError as exc:
+        error_code = exc.response.get('Error', {}).get('Code')
+        if error_code in ('404', 'NoSuchKey'):
+            return {}
+        if error_code in ('403', 'AccessDenied'):
+            logger.warning(f'Access denied reading metadata of {s3_url.geturl()}; assuming no such object')
+            return {}
+        raise
+    return response.get('Metadata', {})
+
 def s3_upload(
     s3_url:str,
     zip_filename:Path,
@@ -609,26 +1266,157 @@ def s3_upload(
         metadata = metadata.copy()
         for k, v in metadata.items():
             metadata[k] = str(v)
-    s3 = boto3.client('s3')
+    s3 = get_boto3_client('s3')
     s3.upload_file(
         Filename=str(zip_filename),
         Bucket=s3_bucket,
         Key=s3_filename,
-        ExtraArgs={'Metadata': metadata}
+        ExtraArgs={'Metadata': metadata},
+        Config=get_s3_transfer_config(),
     )
 
+def search_omit_regexes(omit_regexes:tuple, str_path:str):
+    'Return the match of the first of omit_regexes, from compile_omit_patterns(), found in str_path, or None'
+    for omit_regex in omit_regexes:
+        if rem := omit_regex.search(str_path):
+            return rem
+    return None
+
+def split_omit_patterns(patterns:set):
+    '''
+    Partition omit regexes into a tuple of literal prefixes and a frozenset of remaining regexes.
+
+    A pattern like '^python/boto3' is only a fixed-prefix test, which str.startswith() answers much
+    faster than the regex engine.  Patterns which are anchored with '^' and contain no other regex
+    metacharacters are returned as prefixes (with the '^' removed); everything else is returned as-is.
+    '''
+    prefixes = []
+    regexes = set()
+    for pattern in patterns:
+        if pattern.startswith('^') and not re.search(r'[.^$*+?()\[\]{}|\\]', pattern[1:]):
+            prefixes.append(pattern[1:])
+        else:
+            regexes.add(pattern)
+    return tuple(sorted(prefixes)), frozenset(regexes)
+
+def unpack_wheel(wheel_path:Path, dst_dir:Path):
+    '''
+    Unpack a wheel into dst_dir the way `pip install --target` lays it out, without invoking pip.
+
+    Files under the wheel's `<name>.data/purelib` or `<name>.data/platlib` go to the top of dst_dir.  The
+    other `.data` directories (scripts, headers, data) are skipped; they aren't importable on Lambda.
+    '''
+    with ZipFile(wheel_path) as whl:
+        for zinfo in whl.infolist():
+            path_parts = zinfo.filename.split('/')
+            if path_parts[0].endswith('.data'):
+                if len(path_parts) < 3 or path_parts[1] not in ('purelib', 'platlib'):
+                    continue
+                zinfo.filename = '/'.join(path_parts[2:])
+            whl.extract(zinfo, dst_dir)
+
+def zip_compress_file(
+    file_path:str,
+    compress_type:int = ZIP_DEFLATED,
+    compresslevel:int = None,
+    want_digest:bool = False,
+) -> tuple:
+    '''
+    Read file_path and compress it the same way ZipFile does for compress_type, which must be ZIP_DEFLATED or
+    ZIP_STORED; anything else raises ValueError.  Returns a tuple of (crc32, uncompressed size, compressed data, SHA-256 digest); the first
+    three are what zip_write_compressed() needs.  The digest is None unless want_digest is set.
+
+    Deflate uses zlib-ng when it's installed.  Its output is valid deflate data, but not byte-identical to
+    stock zlib's, so a ZIP's SHA-256 only stays reproducible between builders using the same library.
+
+    This is safe to call from worker threads.
+    '''
+    if compress_type not in (ZIP_DEFLATED, ZIP_STORED):
+        raise ValueError(f'zip_compress_file() only supports ZIP_DEFLATED and ZIP_STORED, not {compress_type}')
+    with open(file_path, 'rb', buffering=0) as src_file:
+        data = read_file_into_buffer(src_file)
+    file_digest = hashlib.sha256(data).digest() if want_digest else None
+    if compress_type == ZIP_STORED:
+        return deflate_zlib.crc32(data), len(data), bytes(data), file_digest
+    if compresslevel == None:
+        compresslevel = deflate_zlib.Z_DEFAULT_COMPRESSION
+    compressor = deflate_zlib.compressobj(compresslevel, deflate_zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    return deflate_zlib.crc32(data), len(data), deflated, file_digest
+
+def zip_write_compressed(zf:ZipFile, zinfo:ZipInfo, crc:int, file_size:int, compressed:bytes):
+    '''
+    Append a member whose data was already compressed by zip_compress_file() to zf.  zinfo.compress_type
+    must match what the data was compressed with.
+
+    ZipFile has no public way to do this, so this mirrors what ZipFile.open(zinfo, 'w') and its close()
+    do internally.  The sizes and CRC are known before the local header is written, so no data descriptor
+    is needed, even if zf's output isn't seekable, and the result is the same as ZipFile.writestr() would
+    have produced.
+    '''
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(compressed)
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader())
+        zf.fp.write(compressed)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+
+def zip_write_file(
+    zf:ZipFile,
+    zinfo:ZipInfo,
+    file_path:str,
+    compresslevel:int = None,
+    writestr_max_size:int = 0,
+    want_digest:bool = False,
+):
+    '''
+    Add file_path to zf as zinfo, compressing it in this thread.  Files smaller than writestr_max_size
+    are read in one call and added with writestr(); bigger ones are streamed.
+
+    Returns the SHA-256 digest of the file's contents if want_digest is set, otherwise None.
+    '''
+    hasher = hashlib.sha256() if want_digest else None
+    if zinfo.file_size < writestr_max_size:
+        with open(file_path, 'rb', buffering=0) as src_file:
+            data = read_file_into_buffer(src_file)
+        zf.writestr(zinfo, data, compresslevel=compresslevel)
+        if hasher:
+            hasher.update(data)
+    else:
+        # ZipFile.open() has no compresslevel argument; this is how ZipFile.write() passes it along
+        zinfo._compresslevel = compresslevel
+        chunk = memoryview(bytearray(1024 * 1024))
+        with open(file_path, 'rb', buffering=0) as src_file, zf.open(zinfo, 'w') as zipped_file:
+            while chunk_size := src_file.readinto(chunk):
+                zipped_file.write(chunk[:chunk_size])
+                if hasher:
+                    hasher.update(chunk[:chunk_size])
+    return hasher.digest() if hasher else None
+
 def cli_entry_point():
     ap = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
     ap.add_argument('--aws-lambda-update', type=str, help='Specifies the AWS Lambda function name to update.  Requires --upload-s3-url.')
     #TODO: implement --extra-dir and --extra-file
     #ap.add_argument('--extra-dir', action='append', help='Extra directory(s) added to the root of your ZIP')
     #ap.add_argument('--extra-file', action='append', help='Extra file(s) added to the root of your ZIP')
+    ap.add_argument('--compress-level', type=int, default=1, choices=range(0, 10), metavar='{0-9}', help='Deflate level for the ZIP files.  Default is 1, the fastest.  0 stores files uncompressed, which is faster still if ZIP size is no concern.')
     ap.add_argument('--git', default=True, dest='git', action='store_true', help='Include git metadata in ZIP and S3 object')
     ap.add_argument('--no-git', dest='git', action='store_false')
     ap.add_argument('--keep', default=False, action='store_true', help='Keep temporary directory for troubleshooting')
     ap.add_argument('--layer-name', type=str, help='Sets the layer name which will contain dependencies')
     ap.add_argument('--layer-s3-url', help='Upload layer to S3 URL, e.g. s3://jsw-lambda/ or s3://jsw-lambda/layername.zip')
     ap.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Sets the logging level.  Must be one of CRITICAL, ERROR, WARNING, INFO, or DEBUG.  Default is INFO.')
+    ap.add_argument('--reuse-zip', default=False, action='store_true', help='Reuse the existing --zip file if it was built from identical source.  Only safe if third-party dependencies are pinned.')
+    ap.add_argument('--skip-unchanged', default=False, action='store_true', help='Skip building and uploading if the --upload-s3-url object was built from identical source.  --aws-lambda-update still happens.  Only safe if third-party dependencies are pinned.')
+    ap.add_argument('--no-build-isolation', dest='build_isolation', default=True, action='store_false', help='Pass --no-build-isolation to pip.  Faster, but build backends of local projects must already be installed.')
     ap.add_argument('--omit', default=[], action='append', help='Regexes used to omit matching path/filenames from the ZIP file, e.g. --omit ^boto3')
     ap.add_argument('--src-dir', type=Path, default=Path('.'), help='Directory containing the lambda package source, e.g. python/example_lambda.  Default to current directory.')
     ap.add_argument('--tmp-dir', type=Path, help='Temporary directory used to install dependencies for zipping')
@@ -664,8 +1452,44 @@ def cli_entry_point():
         if not 'upload_s3_url' in args:
             raise KeyError('You specified --aws-lambda-update which requires you use --upload-s3-url but no S3 URL was given.')
 
-    for omit_pattern in args['omit']:
-        zip_omit.add(omit_pattern)
+    # NewAwsLambdaZip adds zip_omit on its own
+    omit_path_patterns = set(args['omit'])
+
+    local_dep_resolver = LocalDepResolver(build_isolation=args['build_isolation'])
+    if args['reuse_zip'] or (args['skip_unchanged'] and 'upload_s3_url' in args):
+        src_dirs = local_dep_resolver.collect_local_deps(local_dep_dir=args['src_dir'])
+        # the outputs of this and earlier builds may be inside src_dir, e.g. with `--zip pkg.zip`
+        exclude_paths = set()
+        if args['zip'] != None:
+            exclude_paths.add(args['zip'])
+            exclude_paths.add(str(args['zip']) + NewAwsLambdaZip.source_digest_suffix)
+        if 'tmp_dir' in args:
+            exclude_paths.add(args['tmp_dir'])
+        metadata['sourcesha256b64'] = fast_source_digest(
+            src_dirs = src_dirs,
+            base_dir = args['src_dir'],
+            exclude_paths = exclude_paths,
+            build_options = {
+                'compress_level': args['compress_level'],
+                'layer_name': args.get('layer_name'),
+                'omit': sorted(omit_path_patterns),
+            },
+        )
+    if args['skip_unchanged'] and 'upload_s3_url' in args:
+        uploaded_metadata = s3_get_object_metadata(args['upload_s3_url'])
+        # with a layer, the object also has to record which layer version the function should use
+        if uploaded_metadata.get('sourcesha256b64') == metadata['sourcesha256b64'] and (
+            not 'layer_name' in args or 'layerversionarn' in uploaded_metadata
+        ):
+            logger.info(f'Cache hit: {args["upload_s3_url"]} was built from identical source.  Skipping build.')
+            # the function is still updated; a previous update may have failed, or targeted another function
+            if 'aws_lambda_update' in args:
+                aws_lambda_update(
+                    function_name=args['aws_lambda_update'],
+                    s3_url=args['upload_s3_url'],
+                    layer_arn=uploaded_metadata.get('layerversionarn'),
+                )
+            return
 
     if 'tmp_dir' in args:
         try:
@@ -678,15 +1502,40 @@ def cli_entry_point():
         args['tmp_dir'] = Path(tdir.name)
         logger.info(F'Created tmp directory {tdir}')
 
+    if args['compress_level'] == 0:
+        zip_compression, zip_compresslevel = ZIP_STORED, None
+    else:
+        zip_compression, zip_compresslevel = ZIP_DEFLATED, args['compress_level']
+
+    # Without a layer, the function ZIP holds all the dependencies, so it's worth uploading while it's still
+    # being built.  The S3 object isn't replaced unless the build and upload both complete.
+    zip_upload = None
+    if 'upload_s3_url' in args and not 'layer_name' in args and not args['reuse_zip']:
+        s3_url = urllib.parse.urlparse(args['upload_s3_url'])
+        zip_upload = S3MultipartUpload(
+            bucket = s3_url.hostname,
+            key = s3_url.path.lstrip('/'),
+            metadata = metadata,
+        )
     lambda_tmp_dir = Path(args['tmp_dir'], 'lambda')
-    lambda_zip = NewAwsLambdaZip(
-        name = args['aws_lambda_update'],
-        src_dir = args['src_dir'],
-        tmp_dir_for_lambda = lambda_tmp_dir,
-        install_dependencies = False if 'layer_name' in args else True,
-        omit_path_patterns = zip_omit,
-        zip_filename = args['zip'],
-    )
+    try:
+        lambda_zip = NewAwsLambdaZip(
+            name = args['aws_lambda_update'],
+            src_dir = args['src_dir'],
+            tmp_dir_for_lambda = lambda_tmp_dir,
+            install_dependencies = False if 'layer_name' in args else True,
+            omit_path_patterns = omit_path_patterns,
+            zip_filename = args['zip'],
+            zip_compression = zip_compression,
+            zip_compresslevel = zip_compresslevel,
+            local_dep_resolver = local_dep_resolver,
+            source_digest = metadata['sourcesha256b64'] if args['reuse_zip'] else None,
+            stream_to = zip_upload,
+        )
+    except:
+        if zip_upload != None:
+            zip_upload.abort()
+        raise
 
     if 'layer_name' in args:
         layer_tmp_dir = Path(args['tmp_dir'], 'layer')
@@ -696,17 +1545,25 @@ def cli_entry_point():
             omit_pathnames = lambda_zip.zip_namelist,
             s3_url = urllib.parse.urlparse(args['layer_s3_url']) if args['layer_s3_url'] else None,
             tmp_dir_for_layer = layer_tmp_dir,
+            zip_compression = zip_compression,
+            zip_compresslevel = zip_compresslevel,
+            local_dep_resolver = local_dep_resolver,
         )
-        # get existing layer version(s) and compare their SHA-256 to newly-created .ZIP
-        layer = AwsLambdaLayer.get_lambda_layer(name=args['layer_name'])
+        # compare existing layer versions' SHA-256, newest first, to newly-created .ZIP
+        layer = AwsLambdaLayer(name=args['layer_name'])
         if duplicate := layer.get_highest_version_matching_sha256b64(layer_zip.sha256_b64digest):
             logger.info(f'DUPLICATE new layer .zip has same SHA-256 as already-existing version {duplicate.Version}')
-            use_layer_version = duplicate
+            layer_version_arn = duplicate.LayerVersionArn
         else:
             layer_zip.upload_to_s3()
-            use_layer_version = layer_zip.publish()
+            layer_zip.publish()
+            layer_version_arn = layer_zip.version_arn
+        # recorded on the function's S3 object, so --skip-unchanged can point the function at it later
+        metadata['layerversionarn'] = layer_version_arn
 
-    if 'upload_s3_url' in args:
+    if zip_upload != None:
+        zip_upload.close()
+    elif 'upload_s3_url' in args:
         s3_upload(
             metadata=metadata,
             s3_url=args['upload_s3_url'],
@@ -718,7 +1575,7 @@ def cli_entry_point():
             aws_lambda_update(
                 function_name=args['aws_lambda_update'],
                 s3_url=args['upload_s3_url'],
-                layer_arn=use_layer_version.LayerVersionArn,
+                layer_arn=layer_version_arn,
             )
         else:
             aws_lambda_update(
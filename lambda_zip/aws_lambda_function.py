@@ -1,4 +1,4 @@
-import boto3
+from lambda_zip.boto3_clients import get_boto3_client
 
 class AwsLambdaFunction:
     '''
@@ -21,7 +21,7 @@ class AwsLambdaFunction:
         Wraps boto3 Lambda.Client.client-get_function()
         '''
         if boto3_client == None:
-            boto3_client = boto3.client('lambda')
+            boto3_client = get_boto3_client('lambda')
         get_func_args = {
             'FunctionName': name,
         }
@@ -1,6 +1,5 @@
-import boto3
-
 from lambda_zip.aws_lambda_layer_version import AwsLambdaLayerVersion
+from lambda_zip.boto3_clients import get_boto3_client
 
 class AwsLambdaLayer:
     '''
@@ -16,12 +15,17 @@ class AwsLambdaLayer:
         'LicenseInfo',
         'CompatibleArchitectures',
     ]
+    # PageSize for ListLayerVersions; small enough that a match among the newest versions costs one short call
+    list_versions_page_size = 50
 
     def __init__(self, name:str):
         self.name = name
         self.available_versions = dict()
+        self.all_versions_listed = False
         self.highest_version = None
         self.version_details = dict()
+        # description-encoded sha256b64 -> highest AwsLambdaLayerVersion with it, for versions seen so far
+        self.versions_by_sha256b64 = dict()
 
     @classmethod
     def get_lambda_layer(
@@ -34,20 +38,12 @@ class AwsLambdaLayer:
         Return an AwsLambdaLayer object.
         '''
         if boto3_lambda_client == None:
-            boto3_lambda_client = boto3.client('lambda')
+            boto3_lambda_client = get_boto3_client('lambda')
 
         retobj = cls(name=name)
 
-        response_iterator = boto3_lambda_client.get_paginator('list_layer_versions').paginate(
-            LayerName=name
-        )
-        for response_page in response_iterator:
-            for layer_version in response_page.get('LayerVersions', []):
-                # create an AwsLambdaLayerVersion object wrapping the response and add it to available_versions
-                lvobj = AwsLambdaLayerVersion(**layer_version)
-                retobj.available_versions[layer_version['Version']] = lvobj
-                if retobj.highest_version == None or retobj.highest_version.Version < lvobj.Version:
-                    retobj.highest_version = lvobj
+        for lvobj in retobj.iter_versions(boto3_lambda_client=boto3_lambda_client):
+            pass
         # copy some attributes from the highest version to the overall AwsLambdaLayer
         for field_name in cls.copy_fields_from_highest_version:
             field_value = getattr(retobj.highest_version, field_name)
@@ -64,18 +60,29 @@ class AwsLambdaLayer:
         retobj = self.get_version_details(version=highest_version, boto3_lambda_client=boto3_lambda_client)
         return retobj
 
-    def get_highest_version_matching_sha256b64(self, search_val):
+    def get_highest_version_matching_sha256b64(
+        self,
+        search_val,
+        boto3_lambda_client=None,
+    ):
         '''
-        Search the available_versions for the highest version with a matching SHA-256.  Returns either
+        Search the layer's versions for the highest version with a matching SHA-256.  Returns either
         an AwsLambdaLayerVersion object or None if there is no apparent match.
 
-        This is used for de-duplication.
+        This is used for de-duplication.  Versions already seen are looked up in versions_by_sha256b64.
+        Otherwise versions are searched highest first, and the search stops at the first match, so usually
+        only the first page of versions is ever fetched from the AWS API.
         '''
-        candidate_match = None
-        for ver, ver_obj in self.available_versions.items():
-            if search_val == ver_obj.get_metadata_sha256b64():
-                candidate_match = ver_obj
-        return candidate_match
+        # versions are listed highest first, so whatever has been indexed includes every version above
+        # the one indexed for search_val
+        if search_val in self.versions_by_sha256b64:
+            return self.versions_by_sha256b64[search_val]
+        if self.all_versions_listed:
+            return None
+        for ver_obj in self.iter_versions(boto3_lambda_client=boto3_lambda_client):
+            if search_val == ver_obj.get_metadata_sha256b64_or_empty_string():
+                return ver_obj
+        return None
 
     def get_version_details(
         self,
@@ -92,3 +99,38 @@ class AwsLambdaLayer:
         )
         self.version_details[version] = retobj
         return retobj
+
+    def iter_versions(
+        self,
+        boto3_lambda_client=None,
+    ):
+        '''
+        Yield an AwsLambdaLayerVersion for each available version of the layer, highest first.  Pages are
+        only fetched from the AWS API as they're needed; every version seen is added to available_versions
+        and versions_by_sha256b64.  Once all versions have been listed, later calls don't call the API again.
+        '''
+        if self.all_versions_listed:
+            for version in sorted(self.available_versions, reverse=True):
+                yield self.available_versions[version]
+            return
+        if boto3_lambda_client == None:
+            boto3_lambda_client = get_boto3_client('lambda')
+
+        # ListLayerVersions returns versions in descending order
+        response_iterator = boto3_lambda_client.get_paginator('list_layer_versions').paginate(
+            LayerName = self.name,
+            PaginationConfig = {'PageSize': self.list_versions_page_size},
+        )
+        for response_page in response_iterator:
+            for layer_version in response_page.get('LayerVersions', []):
+                # create an AwsLambdaLayerVersion object wrapping the response and add it to available_versions
+                lvobj = AwsLambdaLayerVersion(**layer_version)
+                self.available_versions[layer_version['Version']] = lvobj
+                if self.highest_version == None or self.highest_version.Version < lvobj.Version:
+                    self.highest_version = lvobj
+                if sha256b64 := lvobj.get_metadata_sha256b64_or_empty_string():
+                    indexed = self.versions_by_sha256b64.get(sha256b64)
+                    if indexed == None or indexed.Version < lvobj.Version:
+                        self.versions_by_sha256b64[sha256b64] = lvobj
+                yield lvobj
+        self.all_versions_listed = True
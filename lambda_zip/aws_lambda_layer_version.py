@@ -1,9 +1,11 @@
 import json
 import logging
 
-import boto3
+from lambda_zip.boto3_clients import get_boto3_client
 
 logger = logging.getLogger(__name__)
+# AwsLambdaLayerVersion.metadata before the description has been parsed; None means there's no valid metadata
+metadata_unset = object()
 
 class AwsLambdaLayerVersion:
     '''
@@ -33,7 +35,7 @@ class AwsLambdaLayerVersion:
         LicenseInfo:str=None,
         Version:int=None,
     ):
-        self.metadata = None
+        self.metadata = metadata_unset
         self.CompatibleArchitectures = CompatibleArchitectures
         self.CompatibleRuntimes = CompatibleRuntimes
         self.Content = Content
@@ -52,7 +54,7 @@ class AwsLambdaLayerVersion:
         boto3_lambda_client=None,
     ):
         if boto3_lambda_client == None:
-            boto3_lambda_client = boto3.client('lambda')
+            boto3_lambda_client = get_boto3_client('lambda')
         response = boto3_lambda_client.get_layer_version(
             LayerName=name,
             VersionNumber=version,
@@ -72,14 +74,18 @@ class AwsLambdaLayerVersion:
         SHA-256 of the ZIP.  This reduces the number of AWS API calls required for de-duplication.
 
         If there is no description-encoded metadata, we just return None.
+
+        The result, including None, is cached, so de-duplication can check every version repeatedly without
+        re-parsing (or re-warning about) each description.
         '''
-        if self.metadata != None:
+        if self.metadata is not metadata_unset:
             return self.metadata
         try:
             candidate_metadata = json.loads(self.Description)
         except:
             logger.warning(f"Layer version {self.Version} doesn't have valid description-encoded metadata: "+
                            f"{getattr(self, 'Description', 'MISSING ATTRIBUTE')}")
+            self.metadata = None
             return None
 
         for field_name in self.metadata_required_fields:
@@ -104,6 +110,7 @@ class AwsLambdaLayerVersion:
         The "or empty string" can simplify the calling code.
         '''
         try:
-            self.get_metadata_sha256b64()
+            retstr = self.get_metadata_sha256b64()
         except:
             return ''
+        return '' if retstr == None else retstr
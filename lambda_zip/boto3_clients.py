@@ -0,0 +1,22 @@
+'''
+boto3 clients are expensive to construct (each one loads and parses its service model), so we create
+them from one shared Session and hand out the same client for a given service name every time.
+boto3 clients are thread-safe; Sessions are not, so all client creation goes through here.
+
+boto3 itself is imported on first use, since importing it takes a noticeable fraction of a second and
+plenty of lambda-zip invocations (e.g. --help, or only building a ZIP) never talk to AWS.
+'''
+boto3_session = None
+boto3_clients = dict()
+
+def get_boto3_client(service_name:str):
+    '''
+    Return the shared boto3 client for service_name, e.g. 'lambda' or 's3', creating it on first use.
+    '''
+    global boto3_session
+    if service_name not in boto3_clients:
+        if boto3_session == None:
+            import boto3.session
+            boto3_session = boto3.session.Session()
+        boto3_clients[service_name] = boto3_session.client(service_name)
+    return boto3_clients[service_name]
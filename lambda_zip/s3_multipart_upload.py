@@ -0,0 +1,135 @@
+import logging
+import queue
+import threading
+
+from lambda_zip.boto3_clients import get_boto3_client
+
+logger = logging.getLogger(__name__)
+
+class S3MultipartUpload:
+    '''
+    Write-only, unseekable file-like object which uploads everything written to it as one S3 object, using
+    a multipart upload.  Parts are uploaded by a background thread while the caller keeps writing, so
+    e.g. building a ZIP and uploading it overlap rather than happening one after the other.
+
+    Call close() to finish the upload, or abort() if whatever was writing failed.  Until close() succeeds
+    the S3 object is not created or replaced.
+
+    See https://docs.aws.amazon.com/AmazonS3/latest/userguide/mpuoverview.html
+    '''
+    # S3 requires every part except the last to be at least 5 MiB
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(
+        self,
+        bucket:str,
+        key:str,
+        metadata:dict = None,
+        part_size:int = 16 * 1024 * 1024,
+        max_queued_parts:int = 4,
+        boto3_s3_client = None,
+    ):
+        if part_size < self.min_part_size:
+            raise ValueError(f'part_size {part_size} is smaller than the S3 minimum of {self.min_part_size}')
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.boto3_s3_client = get_boto3_client('s3') if boto3_s3_client == None else boto3_s3_client
+        self.buffer = bytearray()
+        self.closed = False
+        self.error = None
+        self.parts = []
+        # parts handed to upload_thread so far; unlike parts, only ever touched by the writing thread
+        self.queued_part_count = 0
+        # bounded, so a slow network makes write() wait rather than holding the whole object in memory
+        self.part_queue = queue.Queue(maxsize=max_queued_parts)
+
+        # S3 object metadata values must be strings
+        metadata = {} if metadata == None else {k: str(v) for k, v in metadata.items()}
+        response = self.boto3_s3_client.create_multipart_upload(
+            Bucket = self.bucket,
+            Key = self.key,
+            Metadata = metadata,
+        )
+        self.upload_id = response['UploadId']
+        logger.info(f'S3 multipart upload to s3://{self.bucket}/{self.key} started')
+        self.upload_thread = threading.Thread(target=self.upload_parts, daemon=True)
+        self.upload_thread.start()
+
+    def abort(self):
+        'Stop uploading and discard any parts uploaded so far.  The S3 object is left as it was.'
+        if self.closed:
+            return
+        self.closed = True
+        self.part_queue.put(None)
+        self.upload_thread.join()
+        logger.warning(f'S3 multipart upload to s3://{self.bucket}/{self.key} aborted')
+        self.boto3_s3_client.abort_multipart_upload(
+            Bucket = self.bucket,
+            Key = self.key,
+            UploadId = self.upload_id,
+        )
+
+    def close(self):
+        'Upload whatever is still buffered and complete the upload, creating or replacing the S3 object.'
+        if self.closed:
+            return
+        # the last part may be short, but an empty one is only sent if the whole object is empty
+        if len(self.buffer) or self.queued_part_count == 0:
+            self.queue_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.closed = True
+        self.part_queue.put(None)
+        self.upload_thread.join()
+        if self.error != None:
+            self.boto3_s3_client.abort_multipart_upload(
+                Bucket = self.bucket,
+                Key = self.key,
+                UploadId = self.upload_id,
+            )
+            raise self.error
+        self.boto3_s3_client.complete_multipart_upload(
+            Bucket = self.bucket,
+            Key = self.key,
+            UploadId = self.upload_id,
+            MultipartUpload = {'Parts': self.parts},
+        )
+        logger.info(f'S3 multipart upload to s3://{self.bucket}/{self.key} completed in {len(self.parts)} parts')
+
+    def flush(self):
+        pass
+
+    def queue_part(self, part_data:bytes):
+        self.part_queue.put(part_data)
+        self.queued_part_count += 1
+
+    def upload_parts(self):
+        'Runs in upload_thread, uploading parts from part_queue until it gets None.'
+        part_number = 0
+        while (part_data := self.part_queue.get()) != None:
+            part_number += 1
+            # after a failure keep draining the queue, so write() never blocks forever
+            if self.error != None:
+                continue
+            try:
+                response = self.boto3_s3_client.upload_part(
+                    Bucket = self.bucket,
+                    Key = self.key,
+                    UploadId = self.upload_id,
+                    PartNumber = part_number,
+                    Body = part_data,
+                )
+                self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+            except Exception as e:
+                self.error = e
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('write to closed S3MultipartUpload')
+        if self.error != None:
+            raise self.error
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.queue_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
@@ -11,11 +11,12 @@ setup(
     packages = find_packages(),
     install_requires = [
         'boto3',
-        'GitPython',
         'packaging',
-        'pyyaml',
-        'toml'
+        'tomli; python_version < "3.11"',
     ],
+    extras_require = {
+        'zlib-ng': ['zlib-ng'],
+    },
     entry_points = {
         'console_scripts': [
             'lambda-zip = lambda_zip:cli_entry_point',
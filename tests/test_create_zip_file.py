@@ -0,0 +1,82 @@
+'''
+Round-trip checks for create_zip_file().
+
+zip_write_compressed() writes members through ZipFile internals, so these make sure a change in CPython's
+zipfile can't silently produce corrupt ZIPs.  Run with `python -m unittest discover tests`.
+'''
+import hashlib
+import io
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+import lambda_zip
+
+class CollectingWriter:
+    'Unseekable file-like object, standing in for an S3MultipartUpload'
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def flush(self):
+        pass
+
+    def write(self, data) -> int:
+        return self.buffer.write(data)
+
+class TestCreateZipFile(unittest.TestCase):
+    source_files = {
+        'empty.txt': b'',
+        'pkg/__init__.py': b'x = 1\n' * 1000,
+        'pkg/random.bin': os.urandom(300 * 1024),
+        # at least create_zip_file()'s compress_in_memory_max_size, so it's streamed through ZipFile
+        'pkg/sub/large.so': os.urandom(1024 * 1024) * 5,
+    }
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.src_dir = Path(self.tmp_dir.name, 'src')
+        for file_name, content in self.source_files.items():
+            Path(self.src_dir, file_name).parent.mkdir(parents=True, exist_ok=True)
+            Path(self.src_dir, file_name).write_bytes(content)
+        self.zip_filename = Path(self.tmp_dir.name, 'out.zip')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_round_trip(self, compression:int, compresslevel:int = None, stream:bool = False):
+        stream_to = CollectingWriter() if stream else None
+        file_digests = dict()
+        lambda_zip.create_zip_file(
+            tmp_dir = self.src_dir,
+            zip_filename = self.zip_filename,
+            compression = compression,
+            compresslevel = compresslevel,
+            stream_to = stream_to,
+            file_digests = file_digests,
+        )
+        with ZipFile(self.zip_filename) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(sorted(zf.namelist()), sorted(self.source_files))
+            for file_name, content in self.source_files.items():
+                self.assertEqual(zf.getinfo(file_name).compress_type, compression)
+                self.assertEqual(zf.read(file_name), content)
+                self.assertEqual(file_digests[file_name], hashlib.sha256(content).digest())
+        if stream:
+            self.assertEqual(stream_to.buffer.getvalue(), self.zip_filename.read_bytes())
+
+    def test_deflated(self):
+        self.check_round_trip(ZIP_DEFLATED, 1)
+
+    def test_deflated_streamed(self):
+        self.check_round_trip(ZIP_DEFLATED, 1, stream=True)
+
+    def test_stored(self):
+        self.check_round_trip(ZIP_STORED)
+
+    def test_stored_streamed(self):
+        self.check_round_trip(ZIP_STORED, stream=True)
+
+if __name__ == '__main__':
+    unittest.main()